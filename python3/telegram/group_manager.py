@@ -13,22 +13,197 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from telegram.ext import Updater, CommandHandler, CallbackContext
+from telegram.ext import Updater, CommandHandler, ChatMemberHandler, CallbackContext
 from telegram import Update
+from telegram.error import RetryAfter, TelegramError
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import get_context
+from multiprocessing.connection import wait
 from os import environ
+from signal import signal, SIGINT, SIGTERM
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import monotonic, sleep
+import hmac
+import json
 import logging
+import ssl
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-updater = Updater(token=environ['TELEGRAM_BOT_TOKEN'], use_context=True)
+# Concurrent requests used by each bulk moderation command
+bulk_workers = int(environ.get('BULK_WORKERS', 8))
+# API requests per second bulk commands send to a single chat, Telegram answers bursts with RetryAfter
+bulk_rate = 20
+# Widest span of message ids a single /purge covers, bounding the deleteMessages calls per command
+purge_limit = 1000
+dispatcher_workers = 4
+
+# Every dispatcher worker may run a bulk command with its own pool, besides the dispatcher and updater threads
+updater = Updater(token=environ['TELEGRAM_BOT_TOKEN'], use_context=True, workers=dispatcher_workers,
+                  request_kwargs={'con_pool_size': dispatcher_workers * (bulk_workers + 1) + 4})
 dispatcher = updater.dispatcher
 
 
+class ChatCache:
+    """Per-chat cache of invite links, administrators and the bot's own rights with TTL and LRU eviction"""
+
+    def __init__(self, ttl=300, admin_ttl=300, max_chats=256):
+        self.ttl = ttl
+        self.admin_ttl = admin_ttl
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        # Bulk moderation handlers run asynchronously and share the cache between threads
+        self._lock = Lock()
+
+    def _entry(self, chat_id):
+        """Returns the cache entry of the chat, evicting the least recently used chat if required"""
+        if chat_id in self._chats:
+            self._chats.move_to_end(chat_id)
+        else:
+            self._chats[chat_id] = {}
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        return self._chats[chat_id]
+
+    def _get(self, chat_id, key, fetch, ttl=None):
+        """Returns the cached value of key, calling fetch lazily once it is missing or expired"""
+        with self._lock:
+            entry = self._entry(chat_id)
+            if key in entry and monotonic() - entry[key][1] <= (self.ttl if ttl is None else ttl):
+                return entry[key][0]
+        # Fetched without the lock so a slow request doesn't hold up lookups in other chats
+        value = fetch()
+        with self._lock:
+            self._entry(chat_id)[key] = (value, monotonic())
+        return value
+
+    def invite_link(self, bot, chat):
+        """Returns the primary invite link of the chat, exporting a new one only if the chat has none"""
+        def fetch():
+            return chat.invite_link or bot.get_chat(chat_id=chat.id).invite_link or \
+                bot.export_chat_invite_link(chat_id=chat.id)
+        return self._get(chat.id, 'invite_link', fetch)
+
+    def admins(self, bot, chat_id):
+        """Returns the user ids of the chat administrators"""
+        return self._get(chat_id, 'admins',
+                         lambda: {member.user.id for member in bot.get_chat_administrators(chat_id=chat_id)},
+                         self.admin_ttl)
+
+    def bot_rights(self, bot, chat_id):
+        """Returns the bot's own membership in the chat, holding its administrator rights"""
+        return self._get(chat_id, 'bot_rights', lambda: bot.get_chat_member(chat_id=chat_id, user_id=bot.id))
+
+    def invalidate(self, chat_id, *keys):
+        """Drops the given keys, or the whole chat if no key is given, from the cache"""
+        with self._lock:
+            if chat_id not in self._chats:
+                return
+            if not keys:
+                del self._chats[chat_id]
+            for key in keys:
+                self._chats[chat_id].pop(key, None)
+
+
+chat_cache = ChatCache(admin_ttl=int(environ.get('ADMIN_CACHE_TTL', 300)))
+
+chat_slots = {}
+chat_slots_lock = Lock()
+
+
+def throttle(chat_id):
+    """Waits for the next free request slot of the chat, spacing bulk requests out to bulk_rate per second"""
+    with chat_slots_lock:
+        now = monotonic()
+        if len(chat_slots) > 1024:
+            for stale in [key for key, value in chat_slots.items() if value < now]:
+                del chat_slots[stale]
+        slot = max(now, chat_slots.get(chat_id, 0))
+        chat_slots[chat_id] = slot + 1 / bulk_rate
+    sleep(slot - now)
+
+
+def call_with_retry(function, **kwargs):
+    """Calls the given bot method within the chat's rate, waiting out flood limits, and returns whether it succeeded"""
+    while True:
+        throttle(kwargs['chat_id'])
+        try:
+            function(**kwargs)
+            return True
+        except RetryAfter as e:
+            sleep(e.retry_after)
+        except TelegramError as e:
+            logging.getLogger(__name__).warning('%s failed: %s', function.__name__, e)
+            return False
+
+
+def pipeline(function, requests):
+    """Runs the bot method over all keyword argument sets concurrently and returns the number of successes"""
+    with ThreadPoolExecutor(max_workers=bulk_workers) as executor:
+        return sum(executor.map(lambda kwargs: call_with_retry(function, **kwargs), requests))
+
+
+def delete_messages(bot, chat_id, message_ids):
+    """Deletes the messages in batches of 100 through deleteMessages, missing messages are skipped by Telegram"""
+    def delete_batch(chat_id, message_ids):
+        bot.request.post(f'{bot.base_url}/deleteMessages', {'chat_id': chat_id, 'message_ids': message_ids})
+    batches = [message_ids[i:i + 100] for i in range(0, len(message_ids), 100)]
+    return pipeline(delete_batch, [{'chat_id': chat_id, 'message_ids': batch} for batch in batches])
+
+
 class AdminTools:
+    # admin check
+    @staticmethod
+    def is_admin(update: Update, context: CallbackContext):
+        """Checks if the sender is an administrator of the chat, replying otherwise"""
+        # Anonymous admins post on behalf of the chat itself
+        sender_chat = update.message.sender_chat
+        if update.effective_chat.type == 'private' or \
+                (sender_chat and sender_chat.id == update.effective_chat.id) or \
+                update.effective_user.id in chat_cache.admins(context.bot, update.effective_chat.id):
+            return True
+        context.bot.send_message(chat_id=update.message.chat_id, text='Only admins can do that!',
+                                 reply_to_message_id=update.message.message_id)
+        return False
+
+    # bot rights check
+    @staticmethod
+    def bot_can(update: Update, context: CallbackContext, right: str):
+        """Checks if the bot holds the given administrator right in the chat, replying otherwise"""
+        if update.effective_chat.type == 'private':
+            return True
+        member = chat_cache.bot_rights(context.bot, update.effective_chat.id)
+        if member.status == 'creator' or getattr(member, right, False):
+            return True
+        context.bot.send_message(chat_id=update.message.chat_id,
+                                 text=f"I need the {right.replace('_', ' ')[4:]} right to do that!",
+                                 reply_to_message_id=update.message.message_id)
+        return False
+
+    # chat member updates
+    @staticmethod
+    def member_update(update: Update, context: CallbackContext):
+        """Invalidates cached admins and bot rights whenever an administrator's status or rights change,
+        dropping the whole chat once the bot leaves it"""
+        member_update = update.chat_member or update.my_chat_member
+        statuses = {member_update.old_chat_member.status, member_update.new_chat_member.status}
+        if statuses & {'administrator', 'creator'}:
+            chat_cache.invalidate(update.effective_chat.id, 'admins')
+        if member_update.new_chat_member.user.id == context.bot.id:
+            if member_update.new_chat_member.status in ('left', 'kicked'):
+                chat_cache.invalidate(update.effective_chat.id)
+            else:
+                chat_cache.invalidate(update.effective_chat.id, 'bot_rights')
+
     # pin
     @staticmethod
     def pin(update: Update, context: CallbackContext):
         """Pins the quoted message in the chat"""
+        if not AdminTools.is_admin(update, context) or not AdminTools.bot_can(update, context, 'can_pin_messages'):
+            return
         if update.message.reply_to_message:
             context.bot.pin_chat_message(chat_id=update.message.chat_id,
                                          message_id=update.message.reply_to_message.message_id)
@@ -38,32 +213,97 @@ class AdminTools:
             context.bot.send_message(chat_id=update.message.chat_id, text='Please quote the message to pin!',
                                      reply_to_message_id=update.message.message_id)
 
+    # targets
+    @staticmethod
+    def targets(update: Update, context: CallbackContext):
+        """Returns the quoted user or channel and any user ids passed as arguments, along with the rejected ones"""
+        users, sender_chats, rejected = [], [], []
+        for arg in context.args:
+            try:
+                user = int(arg)
+            except ValueError:
+                user = 0
+            if user > 0:
+                users.append(user)
+            else:
+                rejected.append(arg)
+        quoted = update.message.reply_to_message
+        if quoted and quoted.sender_chat:
+            # Messages sent on behalf of a chat carry a service account as from_user
+            if quoted.sender_chat.id == update.effective_chat.id:
+                rejected.append('anonymous admin')
+            else:
+                sender_chats.append(quoted.sender_chat.id)
+        elif quoted:
+            users.append(quoted.from_user.id)
+        return list(dict.fromkeys(users)), sender_chats, rejected
+
+    # bulk summary
+    @staticmethod
+    def summary(action: str, done: int, total: int, rejected: list):
+        """Returns the reply summarising a bulk moderation command"""
+        text = f'{action} {done}/{total} targets!'
+        if rejected:
+            text += f" Ignored: {', '.join(rejected)}"
+        return text
+
     # ban
     @staticmethod
     def ban(update: Update, context: CallbackContext):
-        """Bans the quoted member from the chat"""
-        if update.message.reply_to_message:
-            context.bot.kick_chat_member(chat_id=update.message.chat_id, user_id=update.message.reply_to_message.from_user.id)
-            context.bot.send_message(chat_id=update.message.chat_id, text='Banned!',
+        """Bans the quoted member and/or the given user ids from the chat"""
+        if not AdminTools.is_admin(update, context) or not AdminTools.bot_can(update, context, 'can_restrict_members'):
+            return
+        users, sender_chats, rejected = AdminTools.targets(update, context)
+        if users or sender_chats:
+            chat_id = update.message.chat_id
+            banned = pipeline(context.bot.kick_chat_member,
+                              [{'chat_id': chat_id, 'user_id': user} for user in users]) + \
+                pipeline(context.bot.ban_chat_sender_chat,
+                         [{'chat_id': chat_id, 'sender_chat_id': sender_chat} for sender_chat in sender_chats])
+            context.bot.send_message(chat_id=update.message.chat_id,
+                                     text=AdminTools.summary('Banned', banned, len(users) + len(sender_chats), rejected),
                                      reply_to_message_id=update.message.message_id)
         else:
-            context.bot.send_message(chat_id=update.message.chat_id, text='Please quote the user to ban!',
+            context.bot.send_message(chat_id=update.message.chat_id,
+                                     text=AdminTools.summary('Banned', 0, 0, rejected) if rejected else
+                                     'Please quote the user or give user ids to ban!',
                                      reply_to_message_id=update.message.message_id)
 
-    # invite link
-    def invitelink(update: Update, context: CallbackContext):
-        """Returns an invite link for the chat!"""
-        if update.effective_chat.invite_link:
+    # unban
+    @staticmethod
+    def unban(update: Update, context: CallbackContext):
+        """Unbans the quoted member and/or the given user ids from the chat"""
+        if not AdminTools.is_admin(update, context) or not AdminTools.bot_can(update, context, 'can_restrict_members'):
+            return
+        users, sender_chats, rejected = AdminTools.targets(update, context)
+        if users or sender_chats:
+            chat_id = update.message.chat_id
+            unbanned = pipeline(context.bot.unban_chat_member,
+                                [{'chat_id': chat_id, 'user_id': user, 'only_if_banned': True} for user in users]) + \
+                pipeline(context.bot.unban_chat_sender_chat,
+                         [{'chat_id': chat_id, 'sender_chat_id': sender_chat} for sender_chat in sender_chats])
             context.bot.send_message(chat_id=update.message.chat_id,
-                                     text=update.effective_chat.invite_link,
+                                     text=AdminTools.summary('Unbanned', unbanned, len(users) + len(sender_chats),
+                                                             rejected),
                                      reply_to_message_id=update.message.message_id)
         else:
-            context.bot.send_message(chat_id=update.message.chat_id, text=context.bot.export_chat_invite_link(chat_id=update.effective_chat.id),
+            context.bot.send_message(chat_id=update.message.chat_id,
+                                     text=AdminTools.summary('Unbanned', 0, 0, rejected) if rejected else
+                                     'Please quote the user or give user ids to unban!',
                                      reply_to_message_id=update.message.message_id)
 
+    # invite link
+    def invitelink(update: Update, context: CallbackContext):
+        """Returns an invite link for the chat!"""
+        context.bot.send_message(chat_id=update.message.chat_id,
+                                 text=chat_cache.invite_link(context.bot, update.effective_chat),
+                                 reply_to_message_id=update.message.message_id)
+
     # delete
     def delete(update: Update, context: CallbackContext):
         """Deletes the quoted message"""
+        if not AdminTools.is_admin(update, context) or not AdminTools.bot_can(update, context, 'can_delete_messages'):
+            return
         if update.message.reply_to_message:
             context.bot.delete_message(chat_id=update.message.chat_id,
                                        message_id=update.message.reply_to_message.message_id)
@@ -73,12 +313,129 @@ class AdminTools:
             context.bot.send_message(chat_id=update.message.chat_id, text='Please quote the message to delete!',
                                      reply_to_message_id=update.message.message_id)
 
+    # purge
+    @staticmethod
+    def purge(update: Update, context: CallbackContext):
+        """Deletes every message from the quoted one up to the command"""
+        if not AdminTools.is_admin(update, context) or not AdminTools.bot_can(update, context, 'can_delete_messages'):
+            return
+        if update.message.reply_to_message:
+            first = max(update.message.reply_to_message.message_id, update.message.message_id - purge_limit + 1)
+            message_ids = list(range(first, update.message.message_id + 1))
+            batches = -(-len(message_ids) // 100)
+            failed = batches - delete_messages(context.bot, update.message.chat_id, message_ids)
+            text = 'Purged!' if not failed else f'Purge incomplete, {failed}/{batches} batches failed to delete!'
+            if first != update.message.reply_to_message.message_id:
+                text += f' Only the latest {purge_limit} message ids were covered, run /purge again for older ones.'
+            # The command itself is gone, so the summary can't be sent as a reply
+            context.bot.send_message(chat_id=update.message.chat_id, text=text)
+        else:
+            context.bot.send_message(chat_id=update.message.chat_id, text='Please quote the message to purge from!',
+                                     reply_to_message_id=update.message.message_id)
+
 
 dispatcher.add_handler(CommandHandler('pin', AdminTools.pin))
-dispatcher.add_handler(CommandHandler('ban', AdminTools.ban))
+dispatcher.add_handler(CommandHandler('ban', AdminTools.ban, run_async=True))
+dispatcher.add_handler(CommandHandler('unban', AdminTools.unban, run_async=True))
 dispatcher.add_handler(CommandHandler('invitelink', AdminTools.invitelink))
 dispatcher.add_handler(CommandHandler('delete', AdminTools.delete))
+dispatcher.add_handler(CommandHandler('purge', AdminTools.purge, run_async=True))
+dispatcher.add_handler(ChatMemberHandler(AdminTools.member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Validates incoming webhook requests and queues their updates for the dispatcher"""
+    secret = environ.get('WEBHOOK_SECRET', '')
+
+    def do_POST(self):
+        # Header values are decoded as latin-1, compare raw bytes so any input is accepted by compare_digest
+        token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode('latin-1'), self.secret.encode()):
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            update = Update.de_json(data, updater.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            self.send_response(400)
+            self.end_headers()
+            return
+        dispatcher.update_queue.put(update)
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_webhook(server: WebhookServer):
+    """Runs the dispatcher and serves webhook requests in the current process"""
+    Thread(target=dispatcher.start, daemon=True).start()
+    server.serve_forever()
+
+
+def register_webhook():
+    """Points Telegram at the configured webhook URL with the secret token"""
+    updater.bot.set_webhook(url=environ['WEBHOOK_URL'], allowed_updates=Update.ALL_TYPES,
+                            api_kwargs={'secret_token': WebhookHandler.secret})
+
+
+def start_webhook():
+    """Registers the webhook and serves it from the configured number of worker processes"""
+    if not WebhookHandler.secret:
+        raise Exception('WEBHOOK_SECRET must be set to run in webhook mode!')
+    worker_count = int(environ.get('WEBHOOK_WORKERS', 1))
+    if 'ADMIN_CACHE_TTL' not in environ:
+        # Every worker, and every instance behind a load balancer, holds its own cache and only sees part of
+        # the chat_member updates, so keep privileged checks close to live data
+        chat_cache.admin_ttl = 5
+    server = WebhookServer((environ.get('WEBHOOK_LISTEN', '127.0.0.1'), int(environ.get('WEBHOOK_PORT', 8443))),
+                           WebhookHandler)
+    if environ.get('WEBHOOK_CERT'):
+        tls = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        tls.load_cert_chain(environ['WEBHOOK_CERT'], environ.get('WEBHOOK_KEY'))
+        # Handshakes run lazily in the request threads instead of blocking the accepting loop
+        server.socket = tls.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    context = get_context('fork')
+    if environ.get('WEBHOOK_URL'):
+        # Registered from a short-lived process so no API connection is inherited by the workers
+        registration = context.Process(target=register_webhook)
+        registration.start()
+        registration.join()
+        if registration.exitcode != 0:
+            raise Exception('Failed to register the webhook!')
+    # Workers share the listening socket bound above, the kernel balances connections between them
+    workers = [context.Process(target=serve_webhook, args=(server,)) for _ in range(worker_count)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        raise SystemExit(0)
+    signal(SIGTERM, stop)
+    signal(SIGINT, stop)
+
+    # A crashed worker takes the rest down with it, leaving restarts to the process supervisor
+    wait([worker.sentinel for worker in workers])
+    for worker in workers:
+        if not worker.is_alive():
+            logging.getLogger(__name__).error('Webhook worker %s exited with code %s', worker.pid, worker.exitcode)
+    for worker in workers:
+        worker.terminate()
+        worker.join()
+    raise SystemExit(1)
 
 
 if __name__ == '__main__':
-    updater.start_polling()
+    if environ.get('BOT_MODE', 'polling') == 'webhook':
+        start_webhook()
+    else:
+        updater.start_polling(allowed_updates=Update.ALL_TYPES)